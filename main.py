@@ -1,8 +1,12 @@
-from fastapi import FastAPI, Query, HTTPException
-from fastapi.responses import JSONResponse
+from fastapi import FastAPI, Query, HTTPException, BackgroundTasks
+from fastapi.responses import ORJSONResponse
 import yt_dlp
-import os, uuid, requests, json, traceback, base64, tempfile
-from io import BytesIO
+import orjson
+import aiohttp, asyncio
+from aiohttp.payload import StreamReaderPayload
+import os, re, uuid, json, traceback, base64, tempfile
+from collections import OrderedDict
+from concurrent.futures import ThreadPoolExecutor
 from supabase import create_client, Client
 
 # --- ENV Variables ---
@@ -14,90 +18,253 @@ YOUTUBE_COOKIES_BASE64 = os.getenv("YOUTUBE_COOKIES")
 
 # --- Initialize ---
 supabase: Client = create_client(SUPABASE_URL, SUPABASE_KEY)
-app = FastAPI()
+app = FastAPI(default_response_class=ORJSONResponse)
+session: aiohttp.ClientSession = None
+EXECUTOR = ThreadPoolExecutor(max_workers=8)
+DB_EXECUTOR = ThreadPoolExecutor(max_workers=1)
+COOKIE_BYTES: bytes = None
+song_queue: asyncio.Queue = None
+song_writer: asyncio.Task = None
 
 SONGS_FOLDER = "songs"
 IMGS_FOLDER = "imgs"
 GEMINI_ENDPOINT = "https://generativelanguage.googleapis.com/v1beta/models/gemini-2.5-flash:generateContent"
+GEMINI_TIMEOUT = aiohttp.ClientTimeout(total=30)
+UPLOAD_CHUNK_SIZE = 8 * 1024 * 1024
+UPLOAD_RETRIES = 3
+TAG_CACHE_SIZE = 4096
+INSERT_BATCH_SIZE = 20
+INSERT_FLUSH_INTERVAL = 0.25
+_FOLDER_CACHE: dict[str, int] = {}
+_TAG_CACHE: "OrderedDict[str, dict]" = OrderedDict()
+# Filler such as "(Official Video)" and feat. credits; version qualifiers like "(Remix)" are kept
+_SONG_NAME_NOISE = re.compile(
+    r"[(\[]\s*(?:(?:official|music|video|audio|lyrics?|visuali[sz]er|hd|hq|4k)\s*)+[)\]]"
+    r"|[(\[]\s*(?:feat|ft)\b[^)\]]*[)\]]"
+    r"|\b(?:feat|ft)\b\.?[^(\[]*"
+)
+
+# --- Batched Supabase inserts ---
+# Registered before the session hooks so the final flush runs while DB_EXECUTOR is still open
+@app.on_event("startup")
+async def start_song_writer():
+    global song_queue, song_writer
+    song_queue = asyncio.Queue()
+    song_writer = asyncio.create_task(write_songs())
+
+@app.on_event("shutdown")
+async def stop_song_writer():
+    await song_queue.put(None)
+    await song_writer
+
+async def write_songs():
+    loop = asyncio.get_running_loop()
+    running = True
+    while running:
+        rows = []
+        row = await song_queue.get()
+        deadline = loop.time() + INSERT_FLUSH_INTERVAL
+        # Collect rows until the batch is full or the flush interval passes; None means shut down
+        while row is not None:
+            rows.append(row)
+            if len(rows) >= INSERT_BATCH_SIZE:
+                break
+            try:
+                row = await asyncio.wait_for(song_queue.get(), deadline - loop.time())
+            except asyncio.TimeoutError:
+                break
+        else:
+            running = False
+        if rows:
+            await insert_songs(rows)
+
+async def insert_songs(rows):
+    # Inserts run on their own worker so they never queue behind yt-dlp downloads
+    loop = asyncio.get_running_loop()
+    try:
+        await loop.run_in_executor(DB_EXECUTOR, supabase.table("songs").insert(rows).execute)
+        return
+    except Exception:
+        traceback.print_exc()
+    # Retry row by row so one bad row does not drop the rest of the batch
+    for row in rows:
+        try:
+            await loop.run_in_executor(DB_EXECUTOR, supabase.table("songs").insert(row).execute)
+        except Exception as e:
+            print(f"❌ Failed to insert song {row}: {e}")
+
+@app.on_event("startup")
+async def open_session():
+    global session
+    session = aiohttp.ClientSession(connector=aiohttp.TCPConnector(limit=50, limit_per_host=20))
+
+@app.on_event("shutdown")
+async def close_session():
+    await session.close()
+    EXECUTOR.shutdown(wait=False)
+    DB_EXECUTOR.shutdown(wait=False)
 
 # --- Cookie file from env ---
+@app.on_event("startup")
+def decode_cookies():
+    # A missing env var only fails /upload, so "/" stays up for the health check
+    global COOKIE_BYTES
+    if YOUTUBE_COOKIES_BASE64:
+        COOKIE_BYTES = base64.b64decode(YOUTUBE_COOKIES_BASE64)
+
 def write_temp_cookie_file():
-    if not YOUTUBE_COOKIES_BASE64:
+    # One file per download: yt-dlp rewrites its cookie file in place when it exits
+    if COOKIE_BYTES is None:
         raise Exception("YOUTUBE_COOKIES env var missing")
-    cookie_bytes = base64.b64decode(YOUTUBE_COOKIES_BASE64)
     temp = tempfile.NamedTemporaryFile(delete=False, suffix=".txt", mode="wb")
-    temp.write(cookie_bytes)
+    temp.write(COOKIE_BYTES)
     temp.close()
     return temp.name
 
+# --- Run uploads together ---
+async def gather_or_cancel(*coros):
+    # Like asyncio.gather, but the first failure cancels the others and waits for them to stop
+    tasks = [asyncio.ensure_future(coro) for coro in coros]
+    try:
+        await asyncio.wait(tasks, return_when=asyncio.FIRST_EXCEPTION)
+        for task in tasks:
+            if task.done() and task.exception():
+                raise task.exception()
+        return [task.result() for task in tasks]
+    finally:
+        for task in tasks:
+            task.cancel()
+        await asyncio.gather(*tasks, return_exceptions=True)
+
 # --- Folder setup in pCloud ---
-def get_or_create_folder(folder_name):
-    res = requests.get("https://api.pcloud.com/listfolder", params={"auth": AUTH_TOKEN, "folderid": 0})
-    for item in res.json().get("metadata", {}).get("contents", []):
+async def get_or_create_folder(folder_name):
+    if folder_name in _FOLDER_CACHE:
+        return _FOLDER_CACHE[folder_name]
+    async with session.get("https://api.pcloud.com/listfolder", params={"auth": AUTH_TOKEN, "folderid": 0}) as res:
+        data = orjson.loads(await res.read())
+    for item in data.get("metadata", {}).get("contents", []):
         if item.get("isfolder") and item.get("name") == folder_name:
+            _FOLDER_CACHE[folder_name] = item["folderid"]
             return item["folderid"]
-    res = requests.get("https://api.pcloud.com/createfolder", params={"auth": AUTH_TOKEN, "name": folder_name, "folderid": 0})
-    return res.json()["metadata"]["folderid"]
+    async with session.get("https://api.pcloud.com/createfolder", params={"auth": AUTH_TOKEN, "name": folder_name, "folderid": 0}) as res:
+        data = orjson.loads(await res.read())
+    _FOLDER_CACHE[folder_name] = data["metadata"]["folderid"]
+    return _FOLDER_CACHE[folder_name]
 
 # --- Upload file to pCloud ---
-def upload_file(file_buffer, filename, folder_id):
-    file_buffer.seek(0)
-    res = requests.post("https://api.pcloud.com/uploadfile", params={"auth": AUTH_TOKEN, "folderid": folder_id}, files={"file": (filename, file_buffer)})
-    data = res.json()
+class SizedStreamPayload(StreamReaderPayload):
+    # A response stream with a known length, so the multipart POST carries a Content-Length
+    # instead of falling back to chunked transfer encoding
+    def __init__(self, stream, size, **kwargs):
+        super().__init__(stream, **kwargs)
+        self._size = size
+
+async def upload_file(file_data, filename, folder_id):
+    form = aiohttp.FormData()
+    form.add_field("file", file_data, filename=filename)
+    async with session.post("https://api.pcloud.com/uploadfile", params={"auth": AUTH_TOKEN, "folderid": folder_id}, data=form) as res:
+        data = orjson.loads(await res.read())
     fileid = data["metadata"][0]["fileid"]
-    requests.get("https://api.pcloud.com/getfilepublink", params={"auth": AUTH_TOKEN, "fileid": fileid})
     return fileid, filename
 
-# --- Download and extract song + thumbnail ---
-def download_audio_and_thumbnail(video_url, cookie_path):
-    buffer = BytesIO()
-    temp_id = str(uuid.uuid4())
+# --- Chunked (resumable) upload to pCloud ---
+async def upload_file_chunked(file_obj, filename, folder_id):
+    async with session.get("https://api.pcloud.com/upload_create", params={"auth": AUTH_TOKEN}) as res:
+        data = orjson.loads(await res.read())
+    upload_id = data["uploadid"]
+    try:
+        return await write_upload(upload_id, file_obj, filename, folder_id)
+    except BaseException:
+        # Failed or cancelled: drop the partial upload instead of leaving it open on pCloud
+        try:
+            async with session.get("https://api.pcloud.com/upload_delete", params={"auth": AUTH_TOKEN, "uploadid": upload_id}) as res:
+                await res.read()
+        except Exception:
+            traceback.print_exc()
+        raise
+
+async def write_upload(upload_id, file_obj, filename, folder_id):
+    # One buffer is refilled for every chunk instead of allocating a new bytes object each time
+    buffer = bytearray(UPLOAD_CHUNK_SIZE)
+    view = memoryview(buffer)
+    offset = 0
+    # Disk reads run off the event loop so an 8 MiB read does not stall other requests
+    while size := await asyncio.to_thread(file_obj.readinto, buffer):
+        chunk = view[:size]
+        # A failed chunk is re-sent at the same offset; earlier chunks stay on the server
+        for _ in range(UPLOAD_RETRIES):
+            try:
+                async with session.put("https://api.pcloud.com/upload_write", params={"auth": AUTH_TOKEN, "uploadid": upload_id, "uploadoffset": offset}, data=chunk) as res:
+                    data = orjson.loads(await res.read())
+                if data.get("result") == 0:
+                    break
+                error = data.get("error")
+            except (aiohttp.ClientError, asyncio.TimeoutError, orjson.JSONDecodeError) as e:
+                error = e
+        else:
+            raise Exception(f"❌ pCloud upload failed at offset {offset}: {error}")
+        offset += size
+
+    async with session.get("https://api.pcloud.com/upload_save", params={"auth": AUTH_TOKEN, "uploadid": upload_id, "name": filename, "folderid": folder_id}) as res:
+        data = orjson.loads(await res.read())
+    fileid = data["metadata"]["fileid"]
+    return fileid, filename
 
+# --- Download and extract song + thumbnail ---
+def download_audio_and_thumbnail(video_url, temp_id):
+    cookie_path = write_temp_cookie_file()
     ydl_opts = {
-        'format': 'bestaudio/best',
+        # Audio-only formats only: with no ffmpeg pass, a /best fallback would upload the whole video as a song
+        'format': 'bestaudio[ext=m4a]/bestaudio[ext=webm]/bestaudio',
         'outtmpl': f"{temp_id}.%(ext)s",
         'quiet': True,
         'cookiefile': cookie_path,
         'noplaylist': True,
-        'postprocessors': [{
-            'key': 'FFmpegExtractAudio',
-            'preferredcodec': 'mp3',
-            'preferredquality': '192',
-        }],
+        'concurrent_fragment_downloads': 4,
     }
 
-    with yt_dlp.YoutubeDL(ydl_opts) as ydl:
-        info = ydl.extract_info(video_url, download=True)
-        title = info.get("title", "Unknown")
-        thumbnail_url = info.get("thumbnail")
-        full_path = f"{temp_id}.mp3"
+    try:
+        with yt_dlp.YoutubeDL(ydl_opts) as ydl:
+            info = ydl.extract_info(video_url, download=True)
+            title = info.get("title", "Unknown")
+            thumbnail_url = info.get("thumbnail")
+            ext = info["ext"]
+            full_path = f"{temp_id}.{ext}"
+    finally:
+        os.remove(cookie_path)
 
-    filename = f"{title}.mp3"
+    filename = f"{title}.{ext}"
 
-    with open(full_path, 'rb') as f:
-        buffer.write(f.read())
-    buffer.seek(0)
-    os.remove(full_path)
+    # Streamed from disk by the uploader; the caller removes the file
+    audio_file = open(full_path, 'rb')
 
-    return buffer, filename, thumbnail_url, title
+    return audio_file, filename, thumbnail_url, title
 
-def download_thumbnail(url):
-    res = requests.get(url)
-    if res.status_code == 200:
-        return BytesIO(res.content), f"{uuid.uuid4()}.jpg"
-    raise Exception("Thumbnail download failed")
+async def upload_thumbnail(url, temp_id, folder_id):
+    async with session.get(url) as res:
+        if res.status != 200:
+            raise Exception("Thumbnail download failed")
+        # Pipe the CDN body straight into pCloud when its length is known up front;
+        # a compressed body decodes to a different length, so that case is buffered
+        if res.content_length is None or "Content-Encoding" in res.headers:
+            thumb_data = await res.read()
+        else:
+            thumb_data = SizedStreamPayload(res.content, res.content_length)
+        return await upload_file(thumb_data, f"{temp_id}_t.jpg", folder_id)
 
 # --- Gemini Tagging ---
-def get_tags_from_gemini(song_name):
-    PREDEFINED_TAGS = {
-        "genre": ["pop", "rock", "hiphop", "rap", "r&b", "jazz", "blues", "classical", "electronic", "edm", "house", "techno", "trance", "dubstep", "lofi", "indie", "folk", "country", "metal", "reggae", "latin", "kpop", "jpop", "bhajan", "devotional", "sufi", "instrumental", "soundtrack", "acoustic", "chillstep", "ambient"],
-        "mood": ["happy", "sad", "romantic", "chill", "energetic", "dark", "peaceful", "motivational", "angry", "nostalgic", "dreamy", "emotional", "fun", "relaxing", "aggressive", "uplifting", "sensual", "dramatic", "lonely", "hopeful", "spiritual"],
-        "occasion": ["party", "workout", "study", "sleep", "meditation", "travel", "roadtrip", "driving", "wedding", "breakup", "background", "cooking", "cleaning", "gaming", "focus", "night", "morning", "rainy_day", "summer_vibes", "monsoon_mood"],
-        "era": ["80s", "90s", "2000s", "2010s", "2020s", "oldschool", "vintage", "retro", "modern", "trending", "classic", "timeless", "underground", "viral"],
-        "vocal_instrument": ["female_vocals", "male_vocals", "duet", "group", "instrumental_only", "beats_only", "piano", "guitar", "violin", "flute", "drums", "orchestra", "bass", "live", "remix", "acoustic_version", "cover_song", "mashup", "karaoke"]
-    }
+PREDEFINED_TAGS = {
+    "genre": ["pop", "rock", "hiphop", "rap", "r&b", "jazz", "blues", "classical", "electronic", "edm", "house", "techno", "trance", "dubstep", "lofi", "indie", "folk", "country", "metal", "reggae", "latin", "kpop", "jpop", "bhajan", "devotional", "sufi", "instrumental", "soundtrack", "acoustic", "chillstep", "ambient"],
+    "mood": ["happy", "sad", "romantic", "chill", "energetic", "dark", "peaceful", "motivational", "angry", "nostalgic", "dreamy", "emotional", "fun", "relaxing", "aggressive", "uplifting", "sensual", "dramatic", "lonely", "hopeful", "spiritual"],
+    "occasion": ["party", "workout", "study", "sleep", "meditation", "travel", "roadtrip", "driving", "wedding", "breakup", "background", "cooking", "cleaning", "gaming", "focus", "night", "morning", "rainy_day", "summer_vibes", "monsoon_mood"],
+    "era": ["80s", "90s", "2000s", "2010s", "2020s", "oldschool", "vintage", "retro", "modern", "trending", "classic", "timeless", "underground", "viral"],
+    "vocal_instrument": ["female_vocals", "male_vocals", "duet", "group", "instrumental_only", "beats_only", "piano", "guitar", "violin", "flute", "drums", "orchestra", "bass", "live", "remix", "acoustic_version", "cover_song", "mashup", "karaoke"]
+}
+_PREDEFINED_TAGS_JSON = json.dumps(PREDEFINED_TAGS, indent=2)
+_ALLOWED_TAGS = {cat: set(vals) for cat, vals in PREDEFINED_TAGS.items()}
+_JSON_DECODER = json.JSONDecoder()
 
-    prompt = f"""
+_PROMPT_TEMPLATE = """
 Given the song name "{song_name}", identify its primary artist and language.
 Then, suggest appropriate tags from the predefined categories below.
 Use ONLY tags from these predefined lists (do not invent new ones).
@@ -113,24 +280,49 @@ Return the output in this exact JSON format:
   "vocal_instrument": [...]
 }}
 Predefined tag categories:
-{json.dumps(PREDEFINED_TAGS, indent=2)}
+{tags_json}
 """
 
-    response = requests.post(
-        f"{GEMINI_ENDPOINT}?key={GEMINI_API_KEY}",
+def normalize_song_name(song_name):
+    # "Song (Official Video) feat. X" and "song" share one cache entry, "Song (Remix)" does not
+    normalized = " ".join(_SONG_NAME_NOISE.sub(" ", song_name.lower()).split())
+    return normalized or song_name.lower().strip()
+
+async def get_tags_from_gemini(song_name):
+    key = normalize_song_name(song_name)
+    if key in _TAG_CACHE:
+        _TAG_CACHE.move_to_end(key)
+        return _TAG_CACHE[key]
+    tag_data = await fetch_tags_from_gemini(song_name)
+    _TAG_CACHE[key] = tag_data
+    if len(_TAG_CACHE) > TAG_CACHE_SIZE:
+        _TAG_CACHE.popitem(last=False)
+    return tag_data
+
+async def fetch_tags_from_gemini(song_name):
+    prompt = _PROMPT_TEMPLATE.format(song_name=song_name, tags_json=_PREDEFINED_TAGS_JSON)
+
+    async with session.post(
+        GEMINI_ENDPOINT,
+        params={"key": GEMINI_API_KEY},
         headers={"Content-Type": "application/json"},
-        data=json.dumps({"contents": [{"parts": [{"text": prompt}]}]})
-    )
+        data=orjson.dumps({"contents": [{"parts": [{"text": prompt}]}]}),
+        timeout=GEMINI_TIMEOUT
+    ) as response:
+        status = response.status
+        body = await response.read()
 
-    if response.status_code == 200:
+    if status == 200:
         try:
-            raw_text = response.json()["candidates"][0]["content"]["parts"][0]["text"]
-            if raw_text.startswith("```json"):
-                raw_text = raw_text.strip("` \n").replace("json", "", 1).strip()
-            result = json.loads(raw_text)
+            raw_text = orjson.loads(body)["candidates"][0]["content"]["parts"][0]["text"]
+            # Skips any ```json fence or prose around the first JSON object
+            start = raw_text.find("{")
+            if start == -1:
+                raise ValueError("no JSON object in response")
+            result, _ = _JSON_DECODER.raw_decode(raw_text, start)
             tags = []
-            for cat in ["genre", "mood", "occasion", "era", "vocal_instrument"]:
-                tags.extend(result.get(cat, []))
+            for cat, allowed in _ALLOWED_TAGS.items():
+                tags.extend(tag for tag in result.get(cat, []) if tag in allowed)
             return {
                 "artist": result.get("artist", "Unknown"),
                 "language": result.get("language", "english"),
@@ -139,7 +331,35 @@ Predefined tag categories:
         except Exception as e:
             raise Exception(f"❌ Error parsing Gemini response: {e}")
     else:
-        raise Exception(f"❌ Gemini API Error {response.status_code}: {response.text}")
+        raise Exception(f"❌ Gemini API Error {status}: {body.decode(errors='replace')}")
+
+# --- Tag + save song (runs after the response is sent) ---
+async def tag_and_persist(file_id, img_id, song_name):
+    try:
+        tag_data = await get_tags_from_gemini(song_name)
+    except Exception:
+        # The client already has file_id/img_id, so the song is saved untagged rather than lost
+        traceback.print_exc()
+        tag_data = {"artist": "Unknown", "language": "english", "tags": []}
+    await song_queue.put({
+        "file_id": file_id,
+        "img_id": img_id,
+        "name": song_name,
+        "artist": tag_data["artist"],
+        "language": tag_data["language"],
+        "tags": tag_data["tags"],
+        "views": 0,
+        "likes": 0
+    })
+
+# --- Cleanup for a download whose request already failed ---
+def discard_download(future):
+    if future.exception():
+        traceback.print_exception(future.exception())
+        return
+    audio_file = future.result()[0]
+    audio_file.close()
+    os.remove(audio_file.name)
 
 # --- FastAPI Routes ---
 @app.get("/")
@@ -147,44 +367,40 @@ def home():
     return {"message": "✅ Render finished loading"}
 
 @app.get("/upload")
-def upload(link: str = Query(..., description="YouTube video URL")):
+async def upload(bg: BackgroundTasks, link: str = Query(..., description="YouTube video URL")):
     try:
-        cookie_path = write_temp_cookie_file()
-        songs_folder_id = get_or_create_folder(SONGS_FOLDER)
-        imgs_folder_id = get_or_create_folder(IMGS_FOLDER)
-
-        audio_buffer, audio_filename, thumb_url, song_name = download_audio_and_thumbnail(link, cookie_path)
-        thumb_buffer, thumb_filename = download_thumbnail(thumb_url)
-
-        file_id, _ = upload_file(audio_buffer, audio_filename, songs_folder_id)
-        img_id, _ = upload_file(thumb_buffer, thumb_filename, imgs_folder_id)
+        temp_id = uuid.uuid4().hex
+        loop = asyncio.get_running_loop()
+        download = loop.run_in_executor(EXECUTOR, download_audio_and_thumbnail, link, temp_id)
+        try:
+            songs_folder_id, imgs_folder_id = await asyncio.gather(
+                get_or_create_folder(SONGS_FOLDER),
+                get_or_create_folder(IMGS_FOLDER)
+            )
+        except Exception:
+            # The yt-dlp thread cannot be cancelled; fail now and clean up once it finishes
+            download.add_done_callback(discard_download)
+            raise
+        audio_file, audio_filename, thumb_url, song_name = await download
 
-        tag_data = get_tags_from_gemini(song_name)
+        try:
+            (file_id, _), (img_id, _) = await gather_or_cancel(
+                upload_file_chunked(audio_file, audio_filename, songs_folder_id),
+                upload_thumbnail(thumb_url, temp_id, imgs_folder_id)
+            )
+        finally:
+            audio_file.close()
+            os.remove(audio_file.name)
 
-        supabase.table("songs").insert({
-            "file_id": file_id,
-            "img_id": img_id,
-            "name": song_name,
-            "artist": tag_data["artist"],
-            "language": tag_data["language"],
-            "tags": tag_data["tags"],
-            "views": 0,
-            "likes": 0
-        }).execute()
-
-        audio_buffer.close()
-        thumb_buffer.close()
-        os.remove(cookie_path)
+        bg.add_task(tag_and_persist, file_id, img_id, song_name)
 
-        return JSONResponse(content={
+        return ORJSONResponse(content={
             "status": "success",
             "file_id": file_id,
             "img_id": img_id,
-            "name": song_name,
-            "artist": tag_data["artist"],
-            "tags": tag_data["tags"]
+            "name": song_name
         })
 
     except Exception as e:
         traceback.print_exc()
-        return JSONResponse(status_code=500, content={"status": "failure", "error": str(e)})
+        return ORJSONResponse(status_code=500, content={"status": "failure", "error": str(e)})